@@ -1,17 +1,26 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-import subprocess
+from fastapi.responses import StreamingResponse
 import os
 import re
 import logging
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from functools import lru_cache
-from typing import Optional, Dict
+import httpx
+from typing import AsyncIterator, Optional, Dict, List, Tuple
 import hashlib
-import json
-from datetime import datetime, timedelta
+import orjson
+import math
+import operator
+from collections import OrderedDict, deque
+import time
+from contextlib import aclosing
+
+# Redis es opcional: sin el paquete o sin REDIS_URL el cache queda solo en memoria
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
 app = FastAPI()
 
@@ -31,53 +40,178 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Cache mejorado con expiración
+# Cache LRU con expiración
 class ResponseCache:
     def __init__(self, max_size=200, ttl_minutes=60):
-        self.cache: Dict[str, dict] = {}
+        # Entradas (respuesta, instante monotónico de inserción)
+        self.cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
         self.max_size = max_size
-        self.ttl = timedelta(minutes=ttl_minutes)
+        self.ttl_s = ttl_minutes * 60.0
     
     def get(self, key: str) -> Optional[str]:
         if key in self.cache:
-            entry = self.cache[key]
-            if datetime.now() - entry['timestamp'] < self.ttl:
-                return entry['response']
+            response, timestamp = self.cache[key]
+            if time.monotonic() - timestamp < self.ttl_s:
+                self.cache.move_to_end(key)
+                return response
             else:
                 del self.cache[key]
         return None
     
     def set(self, key: str, response: str):
-        if len(self.cache) >= self.max_size:
-            # Eliminar el más antiguo
-            oldest_key = min(self.cache.keys(), key=lambda k: self.cache[k]['timestamp'])
-            del self.cache[oldest_key]
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        elif len(self.cache) >= self.max_size:
+            # Eliminar el menos usado recientemente
+            self.cache.popitem(last=False)
         
-        self.cache[key] = {
-            'response': response,
-            'timestamp': datetime.now()
-        }
+        self.cache[key] = (response, time.monotonic())
 
 response_cache = ResponseCache()
 
-# Thread pool optimizado
-thread_pool = ThreadPoolExecutor(
-    max_workers=3,
-    thread_name_prefix="ollama_worker"
+# Cache semántico (L2): reutiliza respuestas de preguntas parecidas por similitud de embeddings
+class SemanticCache:
+    def __init__(self, max_size=200, ttl_minutes=60, similitud_minima=0.85):
+        self.entries: deque = deque(maxlen=max_size)  # deque descarta la más antigua al llenarse
+        self.ttl_s = ttl_minutes * 60.0
+        self.similitud_minima = similitud_minima
+    
+    @staticmethod
+    def normalizar(vector: List[float]) -> List[float]:
+        norma = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norma for x in vector]
+    
+    def get(self, vector: List[float], namespace: str) -> Optional[str]:
+        # Con vectores normalizados la similitud coseno es el producto punto.
+        # El recorrido es Python puro en el event loop (~4 ms con 200 x 768): no subir max_size sin medir
+        consulta = self.normalizar(vector)
+        ahora = time.monotonic()
+        mejor_respuesta = None
+        mejor_similitud = self.similitud_minima
+        
+        for entry in self.entries:
+            if entry['namespace'] != namespace or ahora - entry['timestamp'] >= self.ttl_s:
+                continue
+            if len(entry['vector']) != len(consulta):
+                continue
+            similitud = sum(map(operator.mul, consulta, entry['vector']))
+            if similitud >= mejor_similitud:
+                mejor_similitud = similitud
+                mejor_respuesta = entry['response']
+        
+        return mejor_respuesta
+    
+    def set(self, vector: List[float], response: str, namespace: str):
+        self.entries.append({
+            'vector': self.normalizar(vector),
+            'response': response,
+            'namespace': namespace,
+            'timestamp': time.monotonic()
+        })
+
+semantic_cache = SemanticCache(ttl_minutes=response_cache.ttl_s / 60)
+
+# Cache compartido en Redis: sobrevive reinicios y lo comparten todos los workers.
+# ResponseCache sigue delante como nivel en memoria de acceso inmediato.
+class RedisCache:
+    def __init__(self, url: Optional[str], ttl_s: float, prefix="chat:", timeout_s=0.2):
+        self.client = None
+        if url and aioredis is None:
+            logger.warning("REDIS_URL definido pero falta el paquete redis - cache solo en memoria")
+        elif url:
+            # Timeouts cortos: un Redis colgado cuenta como fallo de cache, no bloquea la respuesta
+            self.client = aioredis.from_url(
+                url,
+                socket_connect_timeout=timeout_s,
+                socket_timeout=timeout_s
+            )
+        self.ttl_s = ttl_s
+        self.prefix = prefix
+    
+    async def get(self, key: str) -> Optional[str]:
+        if self.client is None:
+            return None
+        try:
+            value = await self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Error Redis: {str(e)}")
+            return None
+        return value.decode() if value else None
+    
+    async def set(self, key: str, response: str):
+        if self.client is None:
+            return
+        try:
+            await self.client.set(self.prefix + key, response, ex=int(self.ttl_s))
+        except Exception as e:
+            logger.warning(f"Error Redis: {str(e)}")
+    
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+redis_cache = RedisCache(os.getenv("REDIS_URL"), ttl_s=response_cache.ttl_s)
+
+# HTTP/2 solo si está instalado h2 (httpx[http2]); si no, HTTP/1.1 con keep-alive
+try:
+    import h2  # noqa: F401
+    HTTP2_DISPONIBLE = True
+except ImportError:
+    HTTP2_DISPONIBLE = False
+
+# Cliente HTTP de Ollama único y persistente (el modelo queda residente en el servidor).
+# En el servidor de Ollama configurar OLLAMA_KEEP_ALIVE=10m y OLLAMA_NUM_PARALLEL.
+OLLAMA_HOST = "http://localhost:11434"
+ollama_client = httpx.AsyncClient(
+    base_url=OLLAMA_HOST,
+    http2=HTTP2_DISPONIBLE,
+    limits=httpx.Limits(
+        max_keepalive_connections=40,
+        max_connections=100,
+        keepalive_expiry=30.0
+    ),
+    timeout=httpx.Timeout(30.0, connect=5.0)
 )
 
+# Generaciones al modelo en curso por hash de mensaje, para unir peticiones idénticas simultáneas.
+# Cada futuro se resuelve con (respuesta, cached); cached es False en las respuestas de respaldo
+generaciones_en_curso: Dict[str, asyncio.Future] = {}
+
+# Limitar generaciones simultáneas al paralelismo configurado en el servidor de Ollama;
+# el exceso espera aquí en lugar de encolarse en el socket de Ollama
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+ollama_semaphore = asyncio.Semaphore(OLLAMA_CONCURRENCY)
+
+# Modelo y opciones de inferencia, configurables por variables de entorno
+# Cuantizado q4_K_M: ~4-6x menos bytes por token que el 12B, suficiente con el prompt guiado.
+# Descargar con: ollama pull llama3.1:8b-instruct-q4_K_M
+MODEL = os.getenv("CHAT_MODEL", "llama3.1:8b-instruct-q4_K_M")
+MODEL_FALLBACK = os.getenv("CHAT_MODEL_FALLBACK", "gemma3:12b")  # Si el principal no está disponible
+modelo_activo = MODEL  # Pasa a MODEL_FALLBACK tras el primer 404 para no repetir el intento fallido
+KEEP_ALIVE = "10m"  # Mantener modelo listo entre peticiones
+OPTS = {
+    "num_thread": 6,
+    "num_predict": int(os.getenv("CHAT_NUM_PREDICT", "256")),  # Tope de tokens: principal palanca de latencia
+    "temperature": 0.3,
+    "top_p": 0.9
+}
+
+# Modelo local de embeddings para el cache semántico
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+# Tope de la consulta de embeddings: el cache semántico no debe retrasar el primer token
+EMBED_TIMEOUT_S = 1.0
+# Pasa a False tras el primer 404 (modelo no descargado) para no reintentar en cada mensaje
+embeddings_disponibles = True
+
 class ChatRequest(BaseModel):
     message: str
     session_id: Optional[str] = None
 
-class ChatResponse(BaseModel):
-    response: str = None
-    error: str = None
-    details: str = None
-    cached: bool = False
+# Cabeceras para que proxies y navegador no almacenen el stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-# Compilar regex una sola vez
-ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+TIMEOUT_RESPONSE = "Estoy optimizando la respuesta. Por favor, revisa en el menú la sección correspondiente o intenta de nuevo."
+FALLBACK_RESPONSE = "En este momento puedo sugerirte: revisa en el menú superior las secciones disponibles. Para ayuda inmediata, ve a Soporte → Contacto."
 
 # Base de conocimiento mejorada de la página
 PAGE_KNOWLEDGE = {
@@ -123,6 +257,16 @@ INTELLIGENT_RESPONSES = {
     "cuenta": "En 'Mi Cuenta' gestionas tu perfil, ves historial de reservas, facturas y configuraciones. Es tu centro de control personal."
 }
 
+# Variantes personalizadas precalculadas por intención (evita concatenar en cada petición)
+FAST_RESPONSES = {
+    intencion: {
+        "base": respuesta,
+        "paso": respuesta + " Sí, te explico cada paso: ",
+        "urgente": respuesta + " Para atención inmediata, ve directamente a Soporte → Contacto."
+    }
+    for intencion, respuesta in INTELLIGENT_RESPONSES.items()
+}
+
 # Patrones de preguntas frecuentes con respuestas optimizadas
 QUESTION_PATTERNS = {
     r"(hola|buenos días|buenas tardes)": "saludo",
@@ -130,40 +274,43 @@ QUESTION_PATTERNS = {
     r"(adios|chao|hasta luego)": "despedida",
     r"(plan|suscripción|precio|tarifa)": "planes_generico",
     r"(reservar|booking|habitación|alojamiento)": "reservas_generico",
-    r"(cancelar|anular)": "cancelacion",
+    r"(cancelar|cancelaci[oó]n|anular)": "cancelacion",
     r"(contacto|soporte|ayuda|whatsapp)": "contacto",
     r"(cuenta|perfil|mis datos)": "cuenta",
     r"(como funciona|qué es|explica)": "explicacion_general"
 }
 
-def remove_ansi(text: str) -> str:
-    """Elimina códigos ANSI del texto de forma eficiente"""
-    return ANSI_ESCAPE.sub('', text)
+# Todos los patrones en una sola regex compilada: cada intención es un grupo con nombre
+QUESTION_REGEX = re.compile(
+    "|".join(f"(?P<{intencion}>{pattern})" for pattern, intencion in QUESTION_PATTERNS.items()),
+    re.IGNORECASE
+)
 
-def generar_hash_mensaje(message: str) -> str:
-    """Genera hash único para el mensaje"""
-    return hashlib.md5(message.lower().strip().encode()).hexdigest()
+# Prioridad de cada intención: orden de QUESTION_PATTERNS (la genérica "explicacion_general" va última)
+PRIORIDAD_INTENCION = {intencion: orden for orden, intencion in enumerate(QUESTION_PATTERNS.values())}
+
+# Mensajes con números (códigos de reserva, fechas) no pasan por el cache semántico
+CONTIENE_NUMEROS = re.compile(r"\d")
+
+def generar_hash_mensaje(message_lower: str) -> str:
+    """Genera hash corto (BLAKE2b de 64 bits) del mensaje ya normalizado para usar como clave de cache"""
+    return hashlib.blake2b(message_lower.encode(), digest_size=8).hexdigest()
 
 def detectar_intencion(message: str) -> Optional[str]:
     """Detecta la intención del mensaje para respuesta rápida"""
-    message_lower = message.lower()
-    
-    for pattern, response_key in QUESTION_PATTERNS.items():
-        if re.search(pattern, message_lower, re.IGNORECASE):
-            return response_key
-    return None
+    # QUESTION_REGEX ya ignora mayúsculas: no hace falta otra copia en minúsculas.
+    # Entre todas las coincidencias gana la de mayor prioridad, no la primera del texto
+    intenciones = {match.lastgroup for match in QUESTION_REGEX.finditer(message)}
+    return min(intenciones, key=PRIORIDAD_INTENCION.__getitem__) if intenciones else None
 
-@lru_cache(maxsize=100)
-def construir_prompt_inteligente(mensaje_usuario: str) -> str:
-    """Construye prompt optimizado con contexto de página"""
-    
-    contexto_pagina = f"""
+# Contexto fijo de la página: se construye una sola vez al importar el módulo
+CONTEXTO_PAGINA = f"""
 INFORMACIÓN ACTUAL DE LA PÁGINA QUANTUM GATEWAY:
 
 ESTRUCTURA Y NAVEGACIÓN:
 - Menú superior: {', '.join(PAGE_KNOWLEDGE['estructura']['menu_superior'])}
 - Secciones principales: {', '.join(PAGE_KNOWLEDGE['estructura']['secciones_principales'])}
-- Flujos comunes: {json.dumps(PAGE_KNOWLEDGE['flujos_usuarios'], indent=2)}
+- Flujos comunes: {orjson.dumps(PAGE_KNOWLEDGE['flujos_usuarios'], option=orjson.OPT_INDENT_2).decode()}
 - Elementos de interfaz: Botones ({', '.join(PAGE_KNOWLEDGE['elementos_ui']['botones'])}), Formularios ({', '.join(PAGE_KNOWLEDGE['elementos_ui']['formularios'])}), Paneles ({', '.join(PAGE_KNOWLEDGE['elementos_ui']['paneles'])})
 
 REGLAS CRÍTICAS DE RESPUESTA:
@@ -180,62 +327,97 @@ EJEMPLOS DE RESPUESTAS ÓPTIMAS:
 
 RESPUESTA A SOLICITUD DEL USUARIO:
 """
-    
-    return contexto_pagina + f"\nUsuario: {mensaje_usuario}\n\nAsistente:"
 
-def procesar_respuesta_rapida(intencion: str, mensaje_original: str) -> Optional[str]:
+def construir_prompt_inteligente(mensaje_usuario: str) -> str:
+    """Construye prompt optimizado con contexto de página"""
+    return CONTEXTO_PAGINA + f"\nUsuario: {mensaje_usuario}\n\nAsistente:"
+
+def procesar_respuesta_rapida(intencion: str, mensaje_lower: str) -> Optional[str]:
     """Genera respuesta rápida basada en intención detectada"""
-    if intencion in INTELLIGENT_RESPONSES:
-        respuesta_base = INTELLIGENT_RESPONSES[intencion]
-        
-        # Personalizar based on message context
-        if "paso a paso" in mensaje_original.lower():
-            return respuesta_base + " Sí, te explico cada paso: "
-        elif "urgente" in mensaje_original.lower():
-            return respuesta_base + " Para atención inmediata, ve directamente a Soporte → Contacto."
-        
-        return respuesta_base
+    variantes = FAST_RESPONSES.get(intencion)
+    if variantes is None:
+        return None
+    
+    # Personalizar según el contexto del mensaje
+    if "paso a paso" in mensaje_lower:
+        return variantes["paso"]
+    elif "urgente" in mensaje_lower:
+        return variantes["urgente"]
+    
+    return variantes["base"]
+
+async def stream_ollama_optimizado(prompt: str) -> AsyncIterator[str]:
+    """Emite los tokens de Ollama a medida que se generan, sin esperar la respuesta completa"""
+    global modelo_activo
+    async with ollama_semaphore:
+        logger.info(f"Generación iniciada - Cupos libres: {ollama_semaphore._value}/{OLLAMA_CONCURRENCY}")
+        for modelo in dict.fromkeys((modelo_activo, MODEL_FALLBACK)):
+            async with ollama_client.stream(
+                "POST",
+                "/api/generate",
+                json={
+                    "model": modelo,
+                    "prompt": prompt,
+                    "stream": True,
+                    "keep_alive": KEEP_ALIVE,
+                    "options": OPTS
+                }
+            ) as result:
+                # 404: el modelo no está descargado en el servidor, probar con el de respaldo
+                if result.status_code == 404 and modelo != MODEL_FALLBACK:
+                    logger.warning(f"Modelo {modelo} no disponible - usando {MODEL_FALLBACK} en adelante")
+                    modelo_activo = MODEL_FALLBACK
+                    continue
+                if result.status_code != 200:
+                    await result.aread()
+                    raise RuntimeError(result.text[:200])
+
+                # Ollama informa fallos a mitad de generación con status 200 y una línea {"error": ...}
+                terminado = False
+                async for linea in result.aiter_lines():
+                    if not linea:
+                        continue
+                    chunk = orjson.loads(linea)
+                    if chunk.get("error"):
+                        raise RuntimeError(str(chunk["error"])[:200])
+                    if chunk.get("response"):
+                        yield chunk["response"]
+                    if chunk.get("done"):
+                        terminado = True
+                        break
+                if not terminado:
+                    raise RuntimeError("Stream de Ollama cortado antes de terminar")
+                return
+
+async def obtener_embedding(texto: str) -> Optional[List[float]]:
+    """Calcula el embedding del mensaje con Ollama; None si no está disponible"""
+    global embeddings_disponibles
+    if not embeddings_disponibles:
+        return None
     
-    return None
-
-def run_ollama_optimizado(prompt: str) -> str:
-    """Ejecuta Ollama con configuración optimizada para velocidad"""
     try:
-        env = os.environ.copy()
-        env.update({
-            "USERPROFILE": os.path.expanduser("~"),
-            "OLLAMA_NO_TTY": "1",
-            "OLLAMA_NUM_THREADS": "6",  # Más threads para mayor velocidad
-            "OLLAMA_KEEP_ALIVE": "10m",  # Mantener modelo listo
-            "OLLAMA_MAX_LOADED_MODELS": "2"
-        })
-        
-        # Modelo optimizado para velocidad
-        model_name = "gemma3:12b"  # o "llama3.1:8b" para máxima velocidad
-        
-        result = subprocess.run(
-            ["ollama", "run", model_name],
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            env=env,
-            timeout=30,  # Timeout reducido
-            cwd=os.path.expanduser("~")  # Directorio de trabajo óptimo
+        result = await asyncio.wait_for(
+            ollama_client.post(
+                "/api/embeddings",
+                json={"model": EMBED_MODEL, "prompt": texto, "keep_alive": KEEP_ALIVE}
+            ),
+            timeout=EMBED_TIMEOUT_S
         )
-
-        if result.returncode != 0:
-            logger.error(f"Error Ollama: {result.stderr[:200]}")
+        if result.status_code == 404:
+            # Modelo de embeddings no descargado: no tiene sentido reintentar en cada mensaje
+            embeddings_disponibles = False
+            logger.warning(f"Embeddings no disponibles, cache semántico desactivado: {result.text[:200]}")
             return None
-
-        raw_response = result.stdout.strip()
-        return remove_ansi(raw_response)
-
-    except subprocess.TimeoutExpired:
-        logger.warning("Timeout Ollama - usando respuesta de respaldo")
-        return "Estoy optimizando la respuesta. Por favor, revisa en el menú la sección correspondiente o intenta de nuevo."
+        if result.status_code != 200:
+            # Fallos transitorios (cola llena, memoria): se omite solo para esta petición
+            logger.warning(f"Error embeddings: {result.text[:200]}")
+            return None
+        return result.json().get("embedding") or None
+    except asyncio.TimeoutError:
+        logger.warning("Timeout embeddings - se omite el cache semántico")
+        return None
     except Exception as e:
-        logger.error(f"Error Ollama: {str(e)}")
+        logger.warning(f"Error embeddings: {str(e)}")
         return None
 
 def mejorar_respuesta_contexto(respuesta: str, mensaje_original: str) -> str:
@@ -254,61 +436,146 @@ def mejorar_respuesta_contexto(respuesta: str, mensaje_original: str) -> str:
     
     return respuesta
 
-@app.post("/chat", response_model=ChatResponse)
+def evento_sse(**datos) -> bytes:
+    """Serializa un evento Server-Sent Events con payload JSON"""
+    return b"data: " + orjson.dumps(datos) + b"\n\n"
+
+def respuesta_sse(eventos: AsyncIterator[bytes]) -> StreamingResponse:
+    """Envuelve un generador de eventos en una respuesta text/event-stream"""
+    return StreamingResponse(eventos, media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def respuesta_inmediata(response: str, cached: bool = False) -> AsyncIterator[bytes]:
+    """Respuesta ya conocida (cache o intención): un único evento final"""
+    yield evento_sse(response=response, cached=cached, done=True)
+
+async def generar_respuesta_modelo(message: str, message_hash: str, session_id: Optional[str], start_time: float, en_curso: asyncio.Future) -> AsyncIterator[bytes]:
+    """Retransmite los tokens del modelo, cachea la respuesta final y la publica en en_curso"""
+    # PASO 3: Cache semántico (L2) para preguntas equivalentes con otra redacción
+    namespace = session_id or ""
+    vector = None
+    if not CONTIENE_NUMEROS.search(message):
+        vector = await obtener_embedding(message)
+        if vector:
+            similar_response = semantic_cache.get(vector, namespace)
+            if similar_response:
+                response_cache.set(message_hash, similar_response)
+                logger.info(f"Respuesta desde cache semántico - Tiempo: {time.monotonic() - start_time:.2f}s")
+                en_curso.set_result((similar_response, True))
+                yield evento_sse(response=similar_response, cached=True, done=True)
+                return
+    
+    # PASO 4: Procesamiento con modelo en streaming
+    prompt = construir_prompt_inteligente(message)
+    partes = []
+    
+    try:
+        # aclosing: si el cliente se desconecta, se cierra el stream de Ollama y se libera el cupo
+        async with aclosing(stream_ollama_optimizado(prompt)) as tokens:
+            async for token in tokens:
+                partes.append(token)
+                yield evento_sse(token=token)
+    except httpx.TimeoutException:
+        logger.warning("Timeout Ollama - usando respuesta de respaldo")
+        en_curso.set_result((TIMEOUT_RESPONSE, False))
+        yield evento_sse(response=TIMEOUT_RESPONSE, done=True)
+        return
+    except Exception as e:
+        logger.error(f"Error Ollama: {str(e)}")
+        partes = []
+    
+    raw_response = "".join(partes).strip()
+    if not raw_response:
+        # Respuesta de respaldo inteligente; no se cachea (igual que TIMEOUT_RESPONSE)
+        # para que un fallo pasajero de Ollama no fije el respaldo durante todo el TTL
+        en_curso.set_result((FALLBACK_RESPONSE, False))
+        yield evento_sse(response=FALLBACK_RESPONSE, done=True)
+        return
+    
+    # PASO 5: Mejorar respuesta con contexto (el evento final reemplaza el texto parcial)
+    final_response = mejorar_respuesta_contexto(raw_response, message)
+    
+    # Cachear solo respuestas completas: con error o sin "done" el stream lanza y no llega aquí
+    response_cache.set(message_hash, final_response)
+    await redis_cache.set(message_hash, final_response)
+    if vector:
+        semantic_cache.set(vector, final_response, namespace)
+    
+    total_time = time.monotonic() - start_time
+    logger.info(f"Respuesta generada - Tiempo: {total_time:.2f}s - Longitud: {len(final_response)}")
+    
+    en_curso.set_result((final_response, True))
+    yield evento_sse(response=final_response, done=True)
+
+async def generar_respuesta_coalescida(message: str, message_hash: str, session_id: Optional[str], start_time: float) -> AsyncIterator[bytes]:
+    """Une peticiones idénticas simultáneas en una sola generación (single-flight)"""
+    en_curso = generaciones_en_curso.get(message_hash)
+    if en_curso is not None:
+        # Otra petición ya genera esta respuesta: esperar su resultado en vez de repetir la inferencia
+        resultado = await asyncio.shield(en_curso)
+        if resultado is not None:
+            response, cached = resultado
+            logger.info(f"Respuesta compartida con generación en curso - Tiempo: {time.monotonic() - start_time:.2f}s")
+            yield evento_sse(response=response, cached=cached, done=True)
+            return
+        # La generación original se interrumpió: esta petición toma el relevo
+        async with aclosing(generar_respuesta_coalescida(message, message_hash, session_id, start_time)) as eventos:
+            async for evento in eventos:
+                yield evento
+        return
+    
+    en_curso = asyncio.get_running_loop().create_future()
+    generaciones_en_curso[message_hash] = en_curso
+    try:
+        async with aclosing(generar_respuesta_modelo(message, message_hash, session_id, start_time, en_curso)) as eventos:
+            async for evento in eventos:
+                yield evento
+    finally:
+        generaciones_en_curso.pop(message_hash, None)
+        if not en_curso.done():
+            # Cliente desconectado o error: liberar a quienes esperan sin resultado
+            en_curso.set_result(None)
+
+@app.post("/chat")
 async def chat(req: ChatRequest):
     try:
-        start_time = datetime.now()
+        start_time = time.monotonic()
         
-        if not req.message or not req.message.strip():
+        # Normalizar una sola vez; el original se conserva para el modelo y los embeddings
+        message = (req.message or "").strip()
+        if not message:
             raise HTTPException(status_code=400, detail="El mensaje no puede estar vacío")
         
-        message = req.message.strip()
-        message_hash = generar_hash_mensaje(message)
+        message_lower = message.lower()
+        message_hash = generar_hash_mensaje(message_lower)
         
         logger.info(f"Procesando mensaje: {message[:60]}...")
         
         # PASO 1: Verificar cache (más rápido)
         cached_response = response_cache.get(message_hash)
         if cached_response:
-            logger.info(f"Respuesta desde cache - Tiempo: {(datetime.now() - start_time).total_seconds():.2f}s")
-            return ChatResponse(response=cached_response, cached=True)
+            logger.info(f"Respuesta desde cache - Tiempo: {time.monotonic() - start_time:.2f}s")
+            return respuesta_sse(respuesta_inmediata(cached_response, cached=True))
         
         # PASO 2: Detección rápida de intención
-        intencion = detectar_intencion(message)
+        intencion = detectar_intencion(message_lower)
         if intencion:
-            respuesta_rapida = procesar_respuesta_rapida(intencion, message)
+            respuesta_rapida = procesar_respuesta_rapida(intencion, message_lower)
             if respuesta_rapida:
                 # Cachear respuesta rápida
                 response_cache.set(message_hash, respuesta_rapida)
-                logger.info(f"Respuesta rápida - Intención: {intencion} - Tiempo: {(datetime.now() - start_time).total_seconds():.2f}s")
-                return ChatResponse(response=respuesta_rapida)
-        
-        # PASO 3: Procesamiento con modelo (optimizado)
-        prompt = construir_prompt_inteligente(message)
-        
-        loop = asyncio.get_event_loop()
-        raw_response = await loop.run_in_executor(
-            thread_pool, 
-            run_ollama_optimizado, 
-            prompt
-        )
+                logger.info(f"Respuesta rápida - Intención: {intencion} - Tiempo: {time.monotonic() - start_time:.2f}s")
+                return respuesta_sse(respuesta_inmediata(respuesta_rapida))
         
-        if raw_response is None:
-            # Respuesta de respaldo inteligente
-            fallback_response = "En este momento puedo sugerirte: revisa en el menú superior las secciones disponibles. Para ayuda inmediata, ve a Soporte → Contacto."
-            response_cache.set(message_hash, fallback_response)
-            return ChatResponse(response=fallback_response)
-        
-        # PASO 4: Mejorar respuesta con contexto
-        final_response = mejorar_respuesta_contexto(raw_response, message)
-        
-        # Cachear respuesta final
-        response_cache.set(message_hash, final_response)
-        
-        total_time = (datetime.now() - start_time).total_seconds()
-        logger.info(f"Respuesta generada - Tiempo: {total_time:.2f}s - Longitud: {len(final_response)}")
+        # PASO 2b: Cache compartido en Redis; solo guarda respuestas del modelo, así que
+        # se consulta después de la vía rápida para no pagarle un viaje de red
+        cached_response = await redis_cache.get(message_hash)
+        if cached_response:
+            response_cache.set(message_hash, cached_response)
+            logger.info(f"Respuesta desde Redis - Tiempo: {time.monotonic() - start_time:.2f}s")
+            return respuesta_sse(respuesta_inmediata(cached_response, cached=True))
         
-        return ChatResponse(response=final_response)
+        # PASOS 3-5: Cache semántico y modelo en streaming
+        return respuesta_sse(generar_respuesta_coalescida(message, message_hash, req.session_id, start_time))
 
     except HTTPException:
         raise
@@ -318,7 +585,7 @@ async def chat(req: ChatRequest):
 
 # Endpoints adicionales para inteligencia mejorada
 @app.get("/page-knowledge")
-async def get_page_knowledge():
+async def get_page_knowledge() -> dict:
     """Endpoint para conocer la estructura de la página"""
     return {
         "knowledge_base": PAGE_KNOWLEDGE,
@@ -330,12 +597,14 @@ async def get_page_knowledge():
     }
 
 @app.get("/cache-stats")
-async def get_cache_stats():
+async def get_cache_stats() -> dict:
     """Estadísticas del cache"""
     return {
         "cache_size": len(response_cache.cache),
         "max_size": response_cache.max_size,
-        "ttl_minutes": response_cache.ttl.total_seconds() / 60
+        "ttl_minutes": response_cache.ttl_s / 60,
+        "semantic_cache_size": len(semantic_cache.entries),
+        "redis_enabled": redis_cache.client is not None
     }
 
 @app.on_event("startup")
@@ -345,5 +614,6 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    thread_pool.shutdown(wait=False)
+    await ollama_client.aclose()
+    await redis_cache.close()
     logger.info("Servicio detenido - Cache preservado")
\ No newline at end of file
@@ -0,0 +1,59 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+import chatbot
+from chatbot import detectar_intencion
+
+
+@pytest.mark.parametrize("mensaje, intencion", [
+    ("como funciona el plan", "planes_generico"),
+    ("explica como reservar", "reservas_generico"),
+    ("explica cómo cancelar mi reserva", "cancelacion"),
+    ("quiero cancelar, gracias", "agradecimiento"),
+    ("Hola, ¿qué es esto?", "saludo"),
+    ("qué es Quantum Gateway", "explicacion_general"),
+    ("nada que ver", None),
+])
+def test_detectar_intencion_respeta_prioridad(mensaje, intencion):
+    assert detectar_intencion(mensaje.lower()) == intencion
+
+
+def _eventos_sse(texto):
+    return [orjson.loads(evento[len("data: "):]) for evento in texto.split("\n\n") if evento.startswith("data: ")]
+
+
+@pytest.mark.parametrize("lineas", [
+    [{"response": "Ve a Reser", "done": False}, {"error": "model runner has unexpectedly stopped"}],
+    [{"response": "Ve a Reser", "done": False}],
+])
+def test_stream_con_error_o_incompleto_usa_respaldo_sin_cachear(monkeypatch, lineas):
+    def handler(request):
+        contenido = "\n".join(orjson.dumps(linea).decode() for linea in lineas) + "\n"
+        return httpx.Response(200, content=contenido)
+
+    monkeypatch.setattr(chatbot, "ollama_client", httpx.AsyncClient(
+        base_url="http://ollama", transport=httpx.MockTransport(handler)
+    ))
+    # Con números el mensaje no pasa por el cache semántico (sin llamada a embeddings)
+    mensaje = "dónde veo la factura 42"
+    client = TestClient(chatbot.app)
+
+    eventos = _eventos_sse(client.post("/chat", json={"message": mensaje}).text)
+
+    assert eventos[-1]["response"] == chatbot.FALLBACK_RESPONSE
+    assert chatbot.response_cache.get(chatbot.generar_hash_mensaje(mensaje.lower())) is None
+
+
+@pytest.mark.parametrize("status, disponibles", [(503, True), (500, True), (404, False)])
+def test_embeddings_solo_se_desactivan_con_404(monkeypatch, status, disponibles):
+    monkeypatch.setattr(chatbot, "embeddings_disponibles", True)
+    monkeypatch.setattr(chatbot, "ollama_client", httpx.AsyncClient(
+        base_url="http://ollama", transport=httpx.MockTransport(lambda request: httpx.Response(status))
+    ))
+
+    assert asyncio.run(chatbot.obtener_embedding("hola")) is None
+    assert chatbot.embeddings_disponibles is disponibles